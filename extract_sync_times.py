@@ -1,23 +1,32 @@
+import json
 import numpy as np
 from pprint import pprint
 from pathlib import Path
 from tools.settings import settings
 from scipy.signal import find_peaks
-from tools.spikesorting import load_recording
+from tools.spikesorting import load_recording, get_probe_files, get_segment_table
+from tools.work_queue import TaskClaim, claim_task, atomic_output
 from spikeinterface.core import BaseRecording, ChunkRecordingExecutor
 
 # %% functions
 def get_sync_timestamps(
         recording: BaseRecording,
         threshold=None,
+        segment_table: list | None = None,
         verbose: bool = False,
         **job_kwargs
 ):
-    
+    """
+    Detect sync pings on a (single channel) recording in parallel chunks.
+
+    Chunks of all recording segments run in the same pool. If segment_table is given
+    (see `tools.spikesorting.get_segment_table`), segment-local samples are shifted by
+    each segment's sample offset, so samples/times are in the concatenated timebase.
+    """
     # executor
     func = _get_sync_times_chunk
     init_func = _init_sync_times_chunk
-    init_args = (recording,threshold)
+    init_args = (recording, threshold, segment_table)
     executor = ChunkRecordingExecutor(
         recording,
         func,
@@ -41,14 +50,21 @@ def get_sync_timestamps(
         ping_samples.extend(np.atleast_1d(samples))
         ping_times.extend(np.atleast_1d(times))
 
-    return np.array(ping_samples), np.array(ping_times)
+    # chunks may finish out of order across segments
+    ping_samples, ping_times = np.array(ping_samples), np.array(ping_times)
+    order = np.argsort(ping_samples, kind='stable')
+    return ping_samples[order], ping_times[order]
 
-def _init_sync_times_chunk(recording: BaseRecording, threshold=None):
+def _init_sync_times_chunk(recording: BaseRecording, threshold=None, segment_table=None):
     # create local dict for each worker
     worker_ctx = {}
     worker_ctx["recording"] = recording
-    worker_ctx["times"] = recording.get_times()
     worker_ctx["threshold"] = threshold
+    if segment_table is not None:
+        worker_ctx["sample_offsets"] = [seg['sample_offset'] for seg in segment_table]
+        worker_ctx["time_offsets"] = [seg['time_offset'] for seg in segment_table]
+    else:
+        worker_ctx["sample_offsets"] = None
     return worker_ctx
 
 def _get_sync_times_chunk(
@@ -61,8 +77,8 @@ def _get_sync_times_chunk(
     `job_kwargs` contains the chunking parameters.
     """
     recording = worker_ctx["recording"]
-    times = worker_ctx["times"]
     threshold = worker_ctx["threshold"]
+    sample_offsets = worker_ctx["sample_offsets"]
 
     traces = recording.get_traces(start_frame=start_frame, end_frame=end_frame, segment_index=segment_index, return_scaled=True)
     # --- Detection Logic ---
@@ -80,7 +96,11 @@ def _get_sync_times_chunk(
     # Convert local chunk indices to global recording indices
     # the offset is the start of the *current* chunk
     ping_samples = event_indices + start_frame
-    ping_times = times[ping_samples]
+    if sample_offsets is None:
+        ping_times = recording.sample_index_to_time(ping_samples, segment_index=segment_index)
+    else:  # map segment samples to global (concatenated) timebase
+        ping_times = worker_ctx["time_offsets"][segment_index] + ping_samples / recording.get_sampling_frequency()
+        ping_samples = ping_samples + sample_offsets[segment_index]
     return ping_samples, ping_times
 
 def get_recording_sync(
@@ -88,17 +108,25 @@ def get_recording_sync(
         rec_folder: Path,
         probe_num: int,
         overwrite: bool = False,
+        concatenate: bool = False,
         threshold=None,
         verbose: bool = False,
-        sync_job_kwargs: dict = dict(n_jobs=8, chunk_duration='10s', progress_bar=True)
+        sync_job_kwargs: dict = dict(n_jobs=8, chunk_duration='10s', progress_bar=True),
+        claim: TaskClaim | None = None
 ):
         global settings
         output_dir = settings.paths.output_dir
         ## get sync times
         # load recording sync channel
         assert f'imec{probe_num}' in raw_file.name, f"(!) Expected imec{probe_num} in {raw_file.name}\nSkipping...\n\n"
-        raw_sync = load_recording(raw_file, include_sync=True)
+        # concatenated sessions: keep segments separate, processed in parallel and mapped to one timebase
+        raw_sync = load_recording(raw_file, concatenate=concatenate, include_sync=True, as_segments=concatenate)
         raw_sync = raw_sync.channel_slice(channel_ids=[raw_sync.channel_ids[-1]]) # type: ignore
+        segment_table = None
+        if concatenate:
+            # same files as `load_recording` concatenates (same folder and format)
+            probe_files = get_probe_files(raw_file.parent, pattern=f'*imec*{raw_file.suffix}')
+            segment_table = get_segment_table(probe_files[probe_num], recording=raw_sync)
 
         # get ping times - get sample indices
         data_output = rec_folder / output_dir
@@ -112,20 +140,35 @@ def get_recording_sync(
                 print(f'(!) Error loading existing sync timestamps for probe {probe_num} in {raw_file.stem}: {e}\nSkipping...\n\n')
                 return None, None
         else:
-            ping_samples, ping_times = get_sync_timestamps(raw_sync, threshold=threshold, verbose=verbose, **sync_job_kwargs)
+            ping_samples, ping_times = get_sync_timestamps(
+                raw_sync, threshold=threshold, segment_table=segment_table, verbose=verbose, **sync_job_kwargs)
             if ping_samples.size==0: # type: ignore
                 print(f'(!) No sync timestamps found for probe {probe_num} in {raw_file.stem}\nSkipping...\n\n')
                 return None, None
             
-            # save to simple npy
-            np.save(data_output / f'ping_samples_probe{probe_num}.npy', ping_samples)
-            np.save(data_output / f'ping_times_probe{probe_num}.npy', ping_times)
+            # save to simple npy, renamed into place once written
+            with atomic_output(data_output / f'ping_samples_probe{probe_num}.npy', claim=claim) as tmp_file:
+                np.save(tmp_file, ping_samples)
+            with atomic_output(data_output / f'ping_times_probe{probe_num}.npy', claim=claim) as tmp_file:
+                np.save(tmp_file, ping_times)
+            if segment_table is not None:
+                with atomic_output(data_output / f'segments_probe{probe_num}.json', claim=claim) as tmp_file:
+                    with open(tmp_file, 'w') as f:
+                        json.dump(segment_table, f, indent=4)
+                print(f'Saved segment offsets for {len(segment_table)} segments')
             print(f'Found {len(ping_samples)} sync timestamps for probe {probe_num} in {raw_file.stem}')
             print(f'Saved sync timestamps to {data_output}')
         return ping_samples, ping_times
 
 # %% main processing loop
-def get_all_sync():
+def get_all_sync(use_queue: bool = False):
+    """
+    Get sync timestamps for all recordings in settings.
+
+    If use_queue, each session/probe is claimed through a lock file in the experiment metadata
+    folder first, so several machines can run this on the same drive.
+    """
+    queue_folder = metadata_folder / 'work_queue' / 'sync'
     for session, properties in recording_sessions.items():
         animal = session.split('_')[0]
         recording_name = session
@@ -143,29 +186,38 @@ def get_all_sync():
         # check for multiple probes, essentially are there multiple .cbin/.bin files?
         raw_folder = rec_folder / raw_dir
         assert raw_folder.exists(), f"(!) No raw data folder found for recording: {rec_folder}\nExpected in: {raw_folder}\nSkipping...\n\n"
-        match raw_files := list(raw_folder.rglob(f'{recording_name}*imec*.cbin')):
+        match probe_files := get_probe_files(raw_folder, recording_name):
             case x if len(x) > 1:
-                print(f'Found multiple raw files for {recording_name}: {x}')
+                print(f'Found multiple probes for {recording_name}: {list(x.values())}')
             case _:
-                print(f'Found single raw file for {recording_name}: {raw_files}')
-
-        # loop over probes
-        for probe_num, raw_file in enumerate(raw_files):
-            print(f'---processing probe {probe_num} from file: {raw_file.name}')
-
-            ## get sync times
-            ping_samples, ping_times = get_recording_sync(
-                raw_file,
-                rec_folder,
-                probe_num,
-                overwrite=overwrite,
-                threshold=None,
-                verbose=True,
-                sync_job_kwargs=dict(n_jobs=8, chunk_duration='10s', progress_bar=True)
-            )
-            if ping_samples is None: # type: ignore
-                print(f'(!) No ping samples found in existing npy files for probe {probe_num}\nSkipping...\n\n')
-                continue
+                print(f'Found single probe for {recording_name}: {list(probe_files.values())}')
+
+        # loop over probes, segments in gate/trigger order
+        for probe_num, segment_files in probe_files.items():
+            raw_file = segment_files[0]
+            print(f'---processing probe {probe_num} from file: {raw_file.name}'
+                  + (f' (+{len(segment_files) - 1} segments)' if concatenate else ''))
+
+            with claim_task(queue_folder if use_queue else None, f'{recording_name}_probe{probe_num}', overwrite=overwrite) as claimed:
+                if not claimed:
+                    continue
+
+                ## get sync times
+                ping_samples, ping_times = get_recording_sync(
+                    raw_file,
+                    rec_folder,
+                    probe_num,
+                    overwrite=overwrite,
+                    concatenate=concatenate,
+                    threshold=None,
+                    verbose=True,
+                    sync_job_kwargs=dict(n_jobs=8, chunk_duration='10s', progress_bar=True),
+                    claim=claimed
+                )
+                if ping_samples is None: # type: ignore
+                    print(f'(!) No ping samples found in existing npy files for probe {probe_num}\nSkipping...\n\n')
+                    continue
+                claimed.mark_done()  # only once sync timestamps were written
 
     print('\nFinished processing all recordings.'.upper())
 
@@ -199,4 +251,5 @@ if __name__ == "__main__":
 
     # % parameters
     overwrite = False
-    get_all_sync()
\ No newline at end of file
+    use_queue = False  # set True to share the run with other machines (lock files in metadata folder)
+    get_all_sync(use_queue=use_queue)
\ No newline at end of file
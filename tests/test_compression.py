@@ -0,0 +1,50 @@
+import shutil
+import numpy as np
+import pytest
+
+mtscomp = pytest.importorskip('mtscomp')
+pytest.importorskip('spikeinterface')
+from tools.compression import decompress_recording
+from tools.spikesorting import read_meta
+
+# 3 AP channels + sync, 1 kHz
+META = """imSampRate=1000
+nSavedChans=4
+snsApLfSy=3,0,1
+snsSaveChanSubset=all
+fileSizeBytes=40000
+fileTimeSecs=5
+firstSample=0
+~imroTbl=(0,3)(0 0 0 500 250 1)(1 0 0 500 250 1)(2 0 0 500 250 1)
+~snsChanMap=(3,0,1)(AP0;0:0)(AP1;1:1)(AP2;2:2)(SY0;768:768)
+~snsGeomMap=(NP1000,1,0,70)(0:43:0:1)(0:11:0:1)(0:59:20:1)
+"""
+
+def test_decompress_range_and_channels(tmp_path):
+    "compress with mtscomp, then decompress a time range and channel subset"
+    data = np.random.default_rng(0).integers(-500, 500, (5000, 4)).astype(np.int16)
+    raw_folder, compressed_folder = tmp_path / 'raw', tmp_path / 'compressed'
+    raw_folder.mkdir()
+    compressed_folder.mkdir()
+    bin_file = raw_folder / 'rec_g0_t0.imec0.ap.bin'
+    data.tofile(bin_file)
+    cbin_file = compressed_folder / 'rec_g0_t0.imec0.ap.cbin'
+    mtscomp.compress(
+        bin_file, cbin_file, cbin_file.with_suffix('.ch'),
+        sample_rate=1000., n_channels=4, dtype=np.int16, chunk_duration=1., n_threads=1
+    )
+    cbin_file.with_suffix('.meta').write_text(META)
+
+    out_file = decompress_recording(
+        cbin_file, out_file=tmp_path / 'out' / 'rec_g0_t0.imec0.ap.bin', time_range=(1.5, 3.2), channels=[0, 2, 3], n_jobs=2
+    )
+    traces = np.fromfile(out_file, dtype=np.int16).reshape(-1, 3)
+    assert np.array_equal(traces, data[1500:3200][:, [0, 2, 3]])
+
+    meta = read_meta(out_file.with_suffix('.meta'))
+    assert meta['nSavedChans'] == '3'
+    assert meta['snsApLfSy'] == '2,0,1'
+    assert meta['firstSample'] == '1500'
+    assert int(meta['fileSizeBytes']) == traces.nbytes
+    assert meta['snsChanMap'] == '(2,0,1)(AP0;0:0)(AP2;2:2)(SY0;768:768)'
+    assert meta['imroTbl'] == '(0,2)(0 0 0 500 250 1)(2 0 0 500 250 1)'
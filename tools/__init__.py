@@ -0,0 +1 @@
+__version__ = '0.1.0'  # see pyproject.toml, spikeinterface checks it when reloading recordings defined in tools
@@ -1,11 +1,24 @@
 # %% Imports
 import os
-from mtscomp import compress
+import zarr
+import argparse
+import numpy as np
+from mtscomp import compress, Reader
 from pathlib import Path
+from numcodecs import Blosc, Delta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from spikeinterface.core import BaseRecording, ChunkRecordingExecutor
+from spikeinterface.core.job_tools import ensure_chunk_size
 from spikeinterface.extractors import read_spikeglx
 from shutil import copyfile
 from pprint import pprint
+try:
+    from tools.work_queue import claim_task, atomic_output
+    from tools.spikesorting import ZarrChannelRecording
+except ImportError:  # installed as top-level module, e.g. `decompress_recording` script
+    from work_queue import claim_task, atomic_output
+    from spikesorting import ZarrChannelRecording
 
 # # %% setup
 # set default parallel processing parameters
@@ -16,8 +29,26 @@ job_kwargs=dict(
 )
 print("\nParallel Job parameters:")
 pprint(job_kwargs, indent=4)
+# parallel parameters for zarr compression, see `compress_recording_zarr`
+zarr_job_kwargs=dict(
+    n_jobs=round(num_cores*0.8),
+    chunk_duration='1s',
+    progress_bar=True,
+)
+default_job_kwargs = dict(cbin=job_kwargs, zarr=zarr_job_kwargs)  # per target format, see `compress_recordings`
+
+def compress_recording(
+        recording_name: str,
+        rec_folder: Path | list | str,
+        target_folder: Path,
+        job_kwargs=job_kwargs,
+        claim=None
+):
+    """
+    Compress raw AP data to '.cbin' (mtscomp), returns the written '.cbin' files.
 
-def compress_recording(recording_name: str, rec_folder: Path | list | str, target_folder: Path, job_kwargs=job_kwargs):
+    If claim is given (see `tools.work_queue.claim_task`), outputs are only written while it is held.
+    """
     if isinstance(rec_folder, str):
         rec_folder = Path(rec_folder)
     elif isinstance(rec_folder, list):
@@ -25,6 +56,7 @@ def compress_recording(recording_name: str, rec_folder: Path | list | str, targe
     
     recording_name = rec_folder.name
     raw_list = list(rec_folder.glob('*imec*'))  # length > 1 multiple probes
+    written = []
     for probe_num, _ in enumerate(raw_list):
         raw_folder = next(rec_folder.glob(f'*imec{probe_num}*'))
 
@@ -44,21 +76,206 @@ def compress_recording(recording_name: str, rec_folder: Path | list | str, targe
 
         # compress bin file to '.cbin' and corresponding cmeta '.ch' json file
         print(f'\ncompressing {raw_file.name} to {target_folder / f"{recording_name}.cbin"}')
-        _ = compress(
-            raw_file,
-            out=target_cbin,
-            outmeta=target_cmeta,
-            sample_rate=fs,
-            n_channels=n_channels,
-            dtype=dtype,
-            **job_kwargs
-        )
+        # written to temporary files, renamed into place once complete
+        with atomic_output(target_cbin, claim) as tmp_cbin, atomic_output(target_cmeta, claim) as tmp_cmeta:
+            _ = compress(
+                raw_file,
+                out=tmp_cbin,
+                outmeta=tmp_cmeta,
+                sample_rate=fs,
+                n_channels=n_channels,
+                dtype=dtype,
+                **job_kwargs
+            )
         print('...compression done.')
-        copyfile(meta_file, target_meta)  # copy the spikeglx meta file
+        with atomic_output(target_meta, claim) as tmp_meta:
+            copyfile(meta_file, tmp_meta)  # copy the spikeglx meta file
         print(f'...copied {meta_file.name} to {target_meta.name}.')
+        written.append(target_cbin)
         print(f'---finished processing {recording_name}---\n')
+    return written
+
+def get_zarr_compressor(clevel: int = 3, blocksize: int = 0):
+    """
+    Lossless compressor for int16 traces: delta + bit-shuffled blosc/zstd.
+
+    Chunks are stored (channels, time), so the delta runs along time within each channel.
+    blocksize (bytes) should cover a whole chunk: blosc otherwise splits chunks into small blocks,
+    which bit-shuffles poorly after the delta.
+    """
+    return dict(
+        compressor=Blosc(cname='zstd', clevel=clevel, shuffle=Blosc.BITSHUFFLE, blocksize=blocksize),
+        filters=[Delta(dtype='int16')],
+    )
+
+def _init_zarr_write_chunk(recording: BaseRecording, zarr_folder: Path):
+    # create local dict for each worker
+    worker_ctx = {}
+    worker_ctx["recording"] = recording
+    worker_ctx["root"] = zarr.open_group(str(zarr_folder), mode='r+')
+    return worker_ctx
+
+def _write_zarr_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    "write one time chunk of all channels, chunks match the zarr time chunks so workers never share one"
+    traces = worker_ctx["recording"].get_traces(start_frame=start_frame, end_frame=end_frame, segment_index=segment_index)
+    worker_ctx["root"][f'traces_seg{segment_index}'][:, start_frame:end_frame] = traces.T
+
+def write_zarr_recording(
+        recording: BaseRecording,
+        zarr_folder: Path,
+        channel_chunk_size: int = 16,
+        clevel: int = 3,
+        job_kwargs=zarr_job_kwargs
+):
+    """
+    Write recording to zarr as (channels, time) arrays, read back with `tools.spikesorting.ZarrChannelRecording`.
+
+    Arrays are chunked by channel_chunk_size channels and job_kwargs['chunk_duration'] of time,
+    and each time chunk is encoded by one parallel worker.
+    """
+    chunk_size = ensure_chunk_size(recording, **job_kwargs)
+    gains, offsets = recording.get_channel_gains(), recording.get_channel_offsets()
+    root = zarr.open_group(str(zarr_folder), mode='w')
+    root.attrs.update(
+        sampling_frequency=recording.get_sampling_frequency(),
+        channel_ids=[str(ch) for ch in recording.channel_ids],
+        gain_to_uV=gains.tolist() if gains is not None else None,
+        offset_to_uV=offsets.tolist() if offsets is not None else None,
+        num_segments=recording.get_num_segments(),
+    )
+    for segment_index in range(recording.get_num_segments()):
+        root.create_dataset(
+            f'traces_seg{segment_index}',
+            shape=(recording.get_num_channels(), recording.get_num_samples(segment_index)),
+            chunks=(channel_chunk_size, chunk_size),
+            dtype=recording.get_dtype(),
+            **get_zarr_compressor(clevel, blocksize=channel_chunk_size * chunk_size * recording.get_dtype().itemsize),
+        )
+
+    executor = ChunkRecordingExecutor(
+        recording,
+        _write_zarr_chunk,
+        _init_zarr_write_chunk,
+        (recording, zarr_folder),
+        job_name='write_zarr_recording',
+        **{**job_kwargs, 'chunk_size': chunk_size}
+    )
+    executor.run()
+    return ZarrChannelRecording(zarr_folder)
+
+def compress_recording_zarr(
+        recording_name: str,
+        rec_folder: Path | list | str,
+        target_folder: Path,
+        channel_chunk_size: int = 16,
+        clevel: int = 3,
+        job_kwargs=zarr_job_kwargs,
+        claim=None
+):
+    """
+    Compress raw AP data to a zarr folder chunked by time and channel groups.
+
+    Alternative to `compress_recording` ('.cbin'). Traces are stored (channels, time) with time
+    chunks of job_kwargs['chunk_duration'] and channel chunks of channel_chunk_size channels, so
+    reading a channel subset (e.g. the sync channel or one shank) only decodes the chunks it needs.
+    Chunks are encoded in parallel (see `write_zarr_recording`).
+    Output is '<target_folder>/<raw file stem>.zarr' (e.g. '*.imec0.ap.zarr') with the '.meta' file;
+    open it with `tools.spikesorting.load_recording` like a '.cbin' file.
+    Returns the written zarr folders; if claim is given (see `tools.work_queue.claim_task`),
+    outputs are only written while it is held.
+    """
+    if isinstance(rec_folder, str):
+        rec_folder = Path(rec_folder)
+    elif isinstance(rec_folder, list):
+        rec_folder = Path(rec_folder[0])  # take the first folder in the list
+
+    recording_name = rec_folder.name
+    raw_list = list(rec_folder.glob('*imec*'))  # length > 1 multiple probes
+    written = []
+    for probe_num, _ in enumerate(raw_list):
+        raw_folder = next(rec_folder.glob(f'*imec{probe_num}*'))
+
+        # all saved channels including sync, probe is attached from '.meta' on load
+        rec = read_spikeglx(raw_folder, load_sync_channel=True, stream_id=f'imec{probe_num}.ap')
+        raw_file = next(raw_folder.glob(f'*imec{probe_num}*ap.bin'))
+        meta_file = next(raw_folder.glob(f'*imec{probe_num}*ap.meta'))
+
+        target_zarr = target_folder / f'{raw_file.with_suffix(".zarr").name}'
+        target_meta = target_folder / f'{meta_file.name}'
+        print(target_zarr, target_meta, sep='\n')
 
-def compress_recordings(recording_pairs, batch_folder, target_folder: Path, project_base_path: Path | None=None, job_kwargs=job_kwargs):
+        print(f'\ncompressing {raw_file.name} to {target_zarr}')
+        with atomic_output(target_zarr, claim) as tmp_zarr:
+            write_zarr_recording(rec, tmp_zarr, channel_chunk_size=channel_chunk_size, clevel=clevel, job_kwargs=job_kwargs)
+        print(f'...compression done ({raw_file.stat().st_size / _get_folder_size(target_zarr):.2f}x).')
+        with atomic_output(target_meta, claim) as tmp_meta:
+            copyfile(meta_file, tmp_meta)  # copy the spikeglx meta file
+        print(f'...copied {meta_file.name} to {target_meta.name}.')
+        written.append(target_zarr)
+        print(f'---finished processing {recording_name}---\n')
+    return written
+
+def _get_folder_size(folder: Path):
+    return sum(f.stat().st_size for f in folder.rglob('*') if f.is_file())
+
+def read_zarr_traces(
+        zarr_folder: Path,
+        start_frame: int | None = None,
+        end_frame: int | None = None,
+        channel_ids: list | None = None,
+        segment_index: int = 0,
+        chunk_duration: float = 1.,
+        n_threads: int = round(num_cores*0.8)
+):
+    """
+    Read traces from a zarr recording (see `compress_recording_zarr`), decoding time chunks in parallel threads.
+
+    Only chunks overlapping the time range and channel_ids are decoded (blosc releases the GIL).
+
+    Returns
+    -------
+    np.ndarray
+        (n_samples, n_channels) raw traces.
+    """
+    rec = ZarrChannelRecording(zarr_folder)
+    start_frame = 0 if start_frame is None else start_frame
+    end_frame = rec.get_num_samples(segment_index) if end_frame is None else end_frame
+    step = int(chunk_duration * rec.get_sampling_frequency())
+    bounds = [(start, min(start + step, end_frame)) for start in range(start_frame, end_frame, step)]
+
+    channel_indices = rec.ids_to_indices(channel_ids) if channel_ids is not None else None
+    n_channels = len(channel_ids) if channel_ids is not None else rec.get_num_channels()
+    segment = rec._recording_segments[segment_index]
+    traces = np.empty((end_frame - start_frame, n_channels), dtype=rec.get_dtype())
+    def _read(bound):
+        start, end = bound
+        traces[start - start_frame:end - start_frame] = segment.get_traces(
+            start_frame=start, end_frame=end, channel_indices=channel_indices)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_read, bounds))
+    return traces
+
+def compress_recordings(
+        recording_pairs,
+        batch_folder,
+        target_folder: Path,
+        project_base_path: Path | None=None,
+        queue_folder: Path | None=None,
+        target_format: str = 'cbin',
+        job_kwargs: dict | None = None
+):
+    """
+    Compress all recordings in recording_pairs.
+
+    target_format is 'cbin' (mtscomp, `compress_recording`) or 'zarr' (`compress_recording_zarr`).
+    job_kwargs default to job_kwargs (cbin) or zarr_job_kwargs (zarr), see `default_job_kwargs`.
+    If queue_folder is set, each recording folder is claimed through a lock file there first
+    (see `tools.work_queue`), so several machines can compress the same batch.
+    """
+    assert target_format in ('cbin', 'zarr'), f"(!) Unknown target format '{target_format}', expected 'cbin' or 'zarr'"
+    compress_func = compress_recording if target_format == 'cbin' else compress_recording_zarr
+    if job_kwargs is None:
+        job_kwargs = default_job_kwargs[target_format]
     for session, properties in recording_pairs.items():
         animal = session.split('_')[0]
         recording_name = session
@@ -87,6 +304,203 @@ def compress_recordings(recording_pairs, batch_folder, target_folder: Path, proj
         target_folder.mkdir(parents=True, exist_ok=True)
         
         for rec_folder in rec_folders:
-            compress_recording(rec_name, rec_folder, target_folder, job_kwargs)
+            with claim_task(queue_folder, f'compress_{target_format}_{rec_folder.name}') as claimed:
+                if claimed and compress_func(rec_name, rec_folder, target_folder, job_kwargs=job_kwargs, claim=claimed):
+                    claimed.mark_done()
 
     print('\nAll recordings processed successfully.')
+
+
+# %% decompression
+_reader = None  # per-worker mtscomp reader
+_output = None  # per-worker output memmap
+
+def _init_decompress_worker(cbin_file, ch_file, out_file, shape, dtype):
+    global _reader, _output
+    _reader = Reader()
+    _reader.open(cbin_file, ch_file)
+    _output = np.memmap(out_file, dtype=dtype, mode='r+', shape=shape)
+
+def _decompress_chunk(chunk_idx, sample_range, channels):
+    "decompress one chunk and write the overlap with sample_range (and channels) to the output"
+    chunk_start, chunk_end = _reader.chunk_bounds[chunk_idx], _reader.chunk_bounds[chunk_idx + 1]
+    start, end = max(chunk_start, sample_range[0]), min(chunk_end, sample_range[1])
+    chunk_offset = _reader.chunk_offsets[chunk_idx]
+    chunk = _reader.read_chunk(chunk_idx, chunk_offset, _reader.chunk_offsets[chunk_idx + 1] - chunk_offset)
+    data = chunk[start - chunk_start:end - chunk_start]
+    if channels is not None:
+        data = data[:, channels]
+    _output[start - sample_range[0]:end - sample_range[0]] = data
+    return chunk_idx
+
+def _subset_meta_table(value: str, idxs: list, header: str | None = None):
+    "keep entries idxs of a SpikeGLX table value '(header)(entry0)(entry1)...', optionally replacing the header"
+    items = value[1:-1].split(')(')
+    return ''.join(f'({item})' for item in [header or items[0]] + [items[1:][i] for i in idxs])
+
+def write_meta(meta_file: Path, target_meta: Path, num_samples: int, first_sample: int = 0, channels=None):
+    """
+    Write SpikeGLX '.meta' for a decompressed (optionally sliced) '.bin' file.
+
+    Updates file size, duration and first sample. If channels, the meta describes the subset as if
+    only those channels were acquired: channel counts (`nSavedChans`, `snsApLfSy`), channel,
+    geometry and imro tables are reduced to the kept channels and `snsSaveChanSubset` is 'all'.
+    """
+    with open(meta_file, 'r') as f:
+        lines = f.read().splitlines()
+    meta = dict(line.partition('=')[::2] for line in lines if '=' in line)
+    n_channels = len(channels) if channels is not None else int(meta['nSavedChans'])
+    updates = dict(
+        fileSizeBytes=num_samples * n_channels * 2,  # int16
+        fileTimeSecs=num_samples / float(meta['imSampRate']),
+        firstSample=int(meta.get('firstSample', 0)) + first_sample,
+    )
+    if channels is not None:
+        if meta.get('snsSaveChanSubset', 'all') == 'all':
+            saved_channels = list(range(int(meta['nSavedChans'])))
+        else:  # e.g. '0:383,768'
+            saved_channels = []
+            for group in meta['snsSaveChanSubset'].split(','):
+                first, _, last = group.partition(':')
+                saved_channels.extend(range(int(first), int(last or first) + 1))
+        # acquired channel index of each kept channel, split into AP, LF and SY channels
+        n_ap, n_lf, n_sy = (int(n) for n in meta['snsApLfSy'].split(','))
+        acquired = [saved_channels[i] for i in channels]
+        ap_idxs = [a for a in acquired if a < n_ap]
+        n_lf_kept = sum(n_ap <= a < n_ap + n_lf for a in acquired)
+        n_sy_kept = sum(a >= n_ap + n_lf for a in acquired)
+        updates.update(
+            nSavedChans=n_channels,
+            snsSaveChanSubset='all',
+            snsApLfSy=f'{len(ap_idxs)},{n_lf_kept},{n_sy_kept}',
+        )
+        updates['~snsChanMap'] = _subset_meta_table(
+            meta['~snsChanMap'], acquired, header=f'{len(ap_idxs)},{n_lf_kept},{n_sy_kept}')
+        if '~snsGeomMap' in meta:  # one entry per AP channel
+            updates['~snsGeomMap'] = _subset_meta_table(meta['~snsGeomMap'], ap_idxs)
+        if '~imroTbl' in meta:  # one entry per AP channel, header '(probe type,n channels)'
+            probe_type = meta['~imroTbl'][1:].split(')', 1)[0].split(',')[0]
+            updates['~imroTbl'] = _subset_meta_table(meta['~imroTbl'], ap_idxs, header=f'{probe_type},{len(ap_idxs)}')
+    with open(target_meta, 'w') as f:
+        for line in lines:
+            key = line.partition('=')[0]
+            f.write(f'{key}={updates[key]}\n' if key in updates else f'{line}\n')
+
+def decompress_recording(
+        cbin_file: Path,
+        out_file: Path | None = None,
+        time_range: tuple | None = None,
+        channels: list | None = None,
+        n_jobs: int = round(num_cores*0.8),
+        overwrite: bool = False
+):
+    """
+    Decompress '.cbin' to a flat '.bin' file, decoding chunks in parallel.
+
+    Chunks are decoded in worker processes and written straight into a preallocated memmap
+    of the output file. The SpikeGLX '.meta' file is restored next to the output.
+
+    Parameters
+    ----------
+    cbin_file : Path
+        Compressed file, with '.ch' and '.meta' files next to it.
+    out_file : Path, optional
+        Output '.bin' file, defaults to cbin_file with '.bin' suffix.
+    time_range : tuple, optional
+        (start, end) in secs to decompress, defaults to whole recording.
+    channels : list, optional
+        Channel indices to keep, unique and increasing (including sync channel, if wanted), defaults to all.
+    n_jobs : int
+        Number of worker processes.
+    """
+    cbin_file = Path(cbin_file)
+    ch_file = cbin_file.with_suffix('.ch')
+    meta_file = cbin_file.with_suffix('.meta')
+    out_file = Path(out_file) if out_file is not None else cbin_file.with_suffix('.bin')
+    if out_file.exists() and not overwrite:
+        print(f'(!) {out_file} already exists, set overwrite=True to replace\nSkipping...\n\n')
+        return out_file
+
+    reader = Reader()
+    reader.open(cbin_file, ch_file)
+    fs, n_channels, dtype = reader.sample_rate, reader.n_channels, reader.dtype
+    chunk_bounds = np.asarray(reader.chunk_bounds)
+    num_samples = int(chunk_bounds[-1])
+    reader.close()
+
+    # samples and chunks to decompress
+    if time_range is None:
+        sample_range = (0, num_samples)
+    else:
+        sample_range = (max(0, int(time_range[0] * fs)), min(num_samples, int(time_range[1] * fs)))
+    assert sample_range[1] > sample_range[0], f'(!) Empty time range {time_range} for {cbin_file.name}'
+    chunk_idxs = np.flatnonzero((chunk_bounds[1:] > sample_range[0]) & (chunk_bounds[:-1] < sample_range[1]))
+    if channels is not None:
+        channels = [int(ch) for ch in channels]
+        assert all(0 <= ch < n_channels for ch in channels), \
+            f'(!) Channel indices must be in [0, {n_channels}) for {cbin_file.name}, got {channels}'
+        assert channels == sorted(set(channels)), f'(!) Channel indices must be unique and increasing, got {channels}'
+    shape = (sample_range[1] - sample_range[0], len(channels) if channels is not None else n_channels)
+
+    # preallocate output, workers write their chunks into it
+    print(f'decompressing {cbin_file.name} to {out_file} ({len(chunk_idxs)} chunks, {n_jobs} workers)')
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    output = np.memmap(out_file, dtype=dtype, mode='w+', shape=shape)
+    del output
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_decompress_worker,
+        initargs=(cbin_file, ch_file, out_file, shape, dtype),
+    ) as executor:
+        futures = [executor.submit(_decompress_chunk, int(i), sample_range, channels) for i in chunk_idxs]
+        for future in futures:
+            future.result()
+    print('...decompression done.')
+
+    if meta_file.exists():
+        target_meta = out_file.with_suffix('.meta')
+        write_meta(meta_file, target_meta, shape[0], first_sample=sample_range[0], channels=channels)
+        print(f'...restored {meta_file.name} to {target_meta.name}.')
+    else:
+        print(f'(!) No meta file found for {cbin_file.name}')
+    return out_file
+
+def main():
+    """
+    Command-line entry point to decompress a '.cbin' recording.
+    """
+    parser = argparse.ArgumentParser(
+        description="Decompress a '.cbin' recording to '.bin' in parallel, with its '.meta' file.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("cbin_file", type=str, help="Path to '.cbin' file (with '.ch' and '.meta' next to it).")
+    parser.add_argument(
+        "--out", metavar="OUT_FILE", type=str, default=None,
+        help="Output '.bin' file (default: next to the '.cbin' file)."
+    )
+    parser.add_argument(
+        "--time-range", metavar=("START", "END"), type=float, nargs=2, default=None,
+        help="Only decompress from START to END (secs)."
+    )
+    parser.add_argument(
+        "--channels", metavar="CHANNEL", type=int, nargs="+", default=None,
+        help="Only decompress these channel indices."
+    )
+    parser.add_argument(
+        "--n-jobs", type=int, default=round(num_cores*0.8),
+        help="Number of worker processes (default: 80%% of cores)."
+    )
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing output file.")
+    args = parser.parse_args()
+
+    decompress_recording(
+        args.cbin_file,
+        out_file=args.out,
+        time_range=args.time_range,
+        channels=args.channels,
+        n_jobs=args.n_jobs,
+        overwrite=args.overwrite,
+    )
+
+if __name__ == "__main__":
+    main()
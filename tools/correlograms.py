@@ -0,0 +1,157 @@
+import os
+import numpy as np
+import polars as pl
+from pathlib import Path
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+# %% Helpers
+_spike_trains = None  # per-worker list of sorted spike time arrays
+
+def _init_ccg_worker(spike_trains):
+    global _spike_trains
+    _spike_trains = spike_trains
+
+def compute_ccg(spikes_a: np.ndarray, spikes_b: np.ndarray, window: float, bin_size: float):
+    """
+    Cross-correlogram of spikes_b relative to spikes_a, for lags in [-window, window).
+
+    Both spike arrays must be sorted. For each spike in a, the spikes of b within the lag window
+    are found with two searchsorted calls, and only those lags are binned, so cost scales with
+    the number of spikes and coincidences instead of all spike pairs.
+
+    Returns
+    -------
+    np.ndarray
+        Counts per lag bin, n_bins = round(2 * window / bin_size).
+    """
+    n_bins = int(round(2 * window / bin_size))
+    lo = np.searchsorted(spikes_b, spikes_a - window, side='left')
+    hi = np.searchsorted(spikes_b, spikes_a + window, side='left')
+    counts = hi - lo
+    if (total := counts.sum()) == 0:
+        return np.zeros(n_bins, dtype=np.int64)
+
+    # indices of all (a, b) spike pairs within the window
+    idx_a = np.repeat(np.arange(len(spikes_a)), counts)
+    starts = np.cumsum(counts) - counts
+    idx_b = np.arange(total) - np.repeat(starts, counts) + np.repeat(lo, counts)
+
+    lags = spikes_b[idx_b] - spikes_a[idx_a]
+    bins = np.clip(np.floor((lags + window) / bin_size).astype(np.int64), 0, n_bins - 1)
+    return np.bincount(bins, minlength=n_bins)
+
+def _compute_ccg_block(pairs, window, bin_size):
+    "compute ccgs for a block of (index_a, index_b) unit pairs"
+    return np.stack([compute_ccg(_spike_trains[a], _spike_trains[b], window, bin_size) for a, b in pairs])
+
+def get_unit_pairs(units: pl.DataFrame, same_probe: bool = True):
+    """
+    Get unit index pairs within each recording (units in one timebase).
+
+    Parameters
+    ----------
+    units : pl.DataFrame
+        Units with `recording_name` and `probe_id` columns, pairs index into its rows.
+    same_probe : bool
+        Only pair units recorded on the same probe.
+    """
+    group_by = ['recording_name', 'probe_id'] if same_probe else ['recording_name']
+    units = units.with_row_index('row_index')
+    pairs = []
+    for _, group in units.group_by(group_by, maintain_order=True):
+        pairs.extend(combinations(group['row_index'].to_list(), 2))
+    return pairs
+
+
+# %% functions
+def get_ccgs(
+        spiking_data: pl.DataFrame,
+        window_ms: float = 50.,
+        bin_ms: float = 1.,
+        regions: list | None = None,
+        region_col: str = 'brain_region',
+        probes: list | None = None,
+        same_probe: bool = True,
+        pairs_per_block: int = 1000,
+        n_jobs: int = round(os.cpu_count()*0.8),
+):
+    """
+    Compute all-pairs cross-correlograms for units in spiking_data, in parallel pair blocks.
+
+    Parameters
+    ----------
+    spiking_data : pl.DataFrame
+        Spiking dataset (e.g. '<experiment>_units_spiking_all.parquet') with one row per unit and
+        spike times in secs (`spike_times_sec`).
+    window_ms, bin_ms : float
+        Lag window (+/-) and bin size of the correlograms.
+    regions : list, optional
+        Only include units in these regions (values of region_col).
+    probes : list, optional
+        Only include units on these probe ids.
+    same_probe : bool
+        Only pair units on the same probe, otherwise all units within a recording.
+    pairs_per_block : int
+        Number of unit pairs per worker task.
+    n_jobs : int
+        Number of worker processes.
+
+    Returns
+    -------
+    ccgs : pl.DataFrame
+        One row per unit pair (`_a`/`_b` unit columns) with `ccg` counts of b relative to a,
+        as an Array column (`ccgs['ccg'].to_numpy()` gives the (n_pairs, n_bins) matrix).
+    lags : np.ndarray
+        Lag bin centers in ms.
+    """
+    units = spiking_data
+    if regions is not None:
+        units = units.filter(pl.col(region_col).is_in(regions))
+    if probes is not None:
+        units = units.filter(pl.col('probe_id').is_in(probes))
+
+    window, bin_size = window_ms / 1000, bin_ms / 1000
+    n_bins = int(round(2 * window / bin_size))
+    lags = (np.arange(n_bins) + 0.5) * bin_ms - window_ms
+
+    pairs = get_unit_pairs(units, same_probe=same_probe)
+    print(f'Computing {len(pairs)} cross-correlograms for {units.height} units ({n_jobs} workers)')
+    if not pairs:
+        return pl.DataFrame(), lags
+
+    spike_trains = [np.sort(np.asarray(spikes, dtype=np.float64)) for spikes in units['spike_times_sec'].to_list()]
+    blocks = [pairs[i:i + pairs_per_block] for i in range(0, len(pairs), pairs_per_block)]
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_ccg_worker, initargs=(spike_trains,)) as executor:
+        ccgs = np.concatenate(list(executor.map(
+            _compute_ccg_block, blocks, [window] * len(blocks), [bin_size] * len(blocks))))
+    print('...cross-correlograms done.')
+
+    pair_idx = np.array(pairs)
+    unit_cols = [col for col in ['recording_name', 'probe_id', 'unit_id', region_col] if col in units.columns]
+    units_a = units.select(unit_cols)[pair_idx[:, 0]].rename({col: f'{col}_a' for col in unit_cols})
+    units_b = units.select(unit_cols)[pair_idx[:, 1]].rename({col: f'{col}_b' for col in unit_cols})
+    # (n_pairs, n_bins) matrix as a fixed-size Array column, no per-element python objects
+    ccgs = pl.concat([units_a, units_b], how='horizontal').with_columns(pl.Series('ccg', ccgs))
+    return ccgs, lags
+
+def get_experiment_ccgs(spiking_file: Path, out_file: Path | None = None, overwrite: bool = False, **ccg_kwargs):
+    """
+    Compute cross-correlograms for an experiment spiking dataset and save to parquet.
+
+    Defaults to '<spiking_file stem>_ccgs.parquet' next to spiking_file; lag bin centers (ms)
+    are saved to '<out_file stem>_lags.npy'.
+    """
+    if out_file is None:
+        out_file = spiking_file.with_name(f'{spiking_file.stem}_ccgs.parquet')
+    lags_file = out_file.with_name(f'{out_file.stem}_lags.npy')
+    if not overwrite and out_file.exists() and lags_file.exists():
+        print(f'Loaded existing cross-correlograms from {out_file}')
+        return pl.read_parquet(out_file), np.load(lags_file)
+
+    spiking_data = pl.read_parquet(spiking_file)
+    ccgs, lags = get_ccgs(spiking_data, **ccg_kwargs)
+    ccgs.write_parquet(out_file)
+    np.save(lags_file, lags)
+    print(f'Saved cross-correlograms to {out_file}')
+    return ccgs, lags
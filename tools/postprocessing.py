@@ -0,0 +1,156 @@
+import json
+import shutil
+import numpy as np
+import polars as pl
+import spikeinterface.full as si
+from pathlib import Path
+from spikeinterface.core import BaseRecording, BaseSorting, ChannelSparsity
+from tools.spikesorting import load_processed_recording
+
+# %% setup
+# extensions computed for aligned units, in order, as `analyzer.compute({name: params})`
+default_extensions = {
+    'random_spikes': dict(method='uniform', max_spikes_per_unit=500),
+    'waveforms': dict(ms_before=1.0, ms_after=2.0),
+    'templates': dict(operators=['average', 'std']),
+    'noise_levels': dict(),
+    'spike_amplitudes': dict(),
+    'template_metrics': dict(),
+    'quality_metrics': dict(),
+}
+
+# %% helpers
+def get_unit_to_channel(session_alignment: pl.DataFrame):
+    "map unit ids to their `original_channel_idx` from the alignment table"
+    return {
+        row[0]: row[1]
+        for row in session_alignment.select(['unit_id', 'original_channel_idx']).iter_rows()
+    }
+
+def get_aligned_sparsity(recording: BaseRecording, unit_to_channel: dict, radius_um: float = 50.):
+    """
+    Build channel sparsity around each unit's aligned channel.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        Recording the units were sorted on, for channel locations.
+    unit_to_channel : dict
+        unit_id -> original_channel_idx (index into recording channels).
+    radius_um : float
+        Channels within this distance of the unit's channel are kept.
+    """
+    locations = recording.get_channel_locations()
+    unit_ids = np.array(list(unit_to_channel.keys()))
+    mask = np.zeros((len(unit_ids), recording.get_num_channels()), dtype=bool)
+    for i, channel_idx in enumerate(unit_to_channel.values()):
+        distances = np.linalg.norm(locations - locations[channel_idx], axis=1)
+        mask[i] = distances <= radius_um
+    return ChannelSparsity(mask, unit_ids, recording.channel_ids)
+
+def _load_analyzer_index(index_file: Path):
+    if index_file.exists():
+        with open(index_file, 'r') as f:
+            return json.load(f)
+    return dict(parts=[])
+
+
+# %% functions
+def create_aligned_analyzer(
+        sorting: BaseSorting,
+        recording: BaseRecording | None,
+        session_alignment: pl.DataFrame,
+        processed_folder: Path,
+        probe_num: int,
+        radius_um: float = 50.,
+        extensions: dict = default_extensions,
+        overwrite: bool = False,
+        job_kwargs: dict = dict(n_jobs=8, chunk_duration='1s', progress_bar=True)
+):
+    """
+    Compute analyzer extensions only for aligned units, on channels around each unit.
+
+    Units in session_alignment (`unit_id`, `original_channel_idx`) are selected from sorting, and
+    analyzers are written to '<processed_folder>/analyzer_aligned_probe<N>_part<k>.zarr'. Units
+    already computed in an earlier part are skipped, so aligning more units later only computes
+    the new ones. Parts are tracked in 'analyzer_aligned_probe<N>.json'.
+    If recording is None, the cached preprocessed recording (see `process_recording`) is used;
+    probe_num is the imec probe number, as in the alignment table `probe_id` and the cache name.
+
+    Returns
+    -------
+    list of SortingAnalyzer
+        All analyzer parts for the probe (see `load_aligned_analyzers`).
+    """
+    index_file = processed_folder / f'analyzer_aligned_probe{probe_num}.json'
+    if overwrite:
+        index_file.unlink(missing_ok=True)
+        for part_folder in processed_folder.glob(f'analyzer_aligned_probe{probe_num}_part*.zarr'):
+            shutil.rmtree(part_folder)
+    index = _load_analyzer_index(index_file)
+    computed_units = {unit_id for part in index['parts'] for unit_id in part['unit_ids']}
+
+    # match alignment units to sorting unit ids
+    sorting_ids = {str(unit_id): unit_id for unit_id in sorting.unit_ids}
+    aligned_units = get_unit_to_channel(session_alignment)
+    if missing := [unit_id for unit_id in aligned_units if str(unit_id) not in sorting_ids]:
+        print(f'(!) {len(missing)} aligned units not found in sorting for probe {probe_num}: {missing}')
+    unit_to_channel = {
+        sorting_ids[str(unit_id)]: channel_idx for unit_id, channel_idx in aligned_units.items()
+        if str(unit_id) in sorting_ids and str(unit_id) not in computed_units
+    }
+    if not unit_to_channel:
+        print(f'All {len(computed_units)} aligned units already computed for probe {probe_num}')
+        return load_aligned_analyzers(processed_folder, probe_num)
+
+    if recording is None:
+        recording = load_processed_recording(processed_folder, probe_num)
+        assert recording is not None, f'(!) No preprocessed recording found for probe {probe_num} in {processed_folder}'
+
+    part_num = len(index['parts'])
+    analyzer_folder = processed_folder / f'analyzer_aligned_probe{probe_num}_part{part_num}.zarr'
+    print(f'...computing {list(extensions)} for {len(unit_to_channel)} aligned units (radius {radius_um} um)')
+    aligned_sorting = sorting.select_units(unit_ids=list(unit_to_channel.keys()))
+    sparsity = get_aligned_sparsity(recording, unit_to_channel, radius_um=radius_um)
+    print(f'...mean channels per unit: {sparsity.mask.sum(axis=1).mean():.1f} of {recording.get_num_channels()}')
+
+    analyzer = si.create_sorting_analyzer(
+        sorting=aligned_sorting,
+        recording=recording,
+        format='zarr',
+        folder=analyzer_folder,
+        sparse=True,
+        sparsity=sparsity,
+        overwrite=True,
+    )
+    analyzer.compute(extensions, **job_kwargs)
+    print(f'Saved aligned analyzer to "{analyzer_folder}"')
+
+    # register part once computed
+    index['parts'].append(dict(
+        folder=analyzer_folder.name,
+        unit_ids=[str(unit_id) for unit_id in unit_to_channel],
+        radius_um=radius_um,
+        extensions=list(extensions),
+    ))
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=4)
+    return load_aligned_analyzers(processed_folder, probe_num)
+
+def load_aligned_analyzers(processed_folder: Path, probe_num: int):
+    "load all aligned analyzer parts for probe, in order computed"
+    index = _load_analyzer_index(processed_folder / f'analyzer_aligned_probe{probe_num}.json')
+    return [
+        si.load_sorting_analyzer(folder=processed_folder / part['folder'], format='zarr')
+        for part in index['parts']
+    ]
+
+def get_aligned_metrics(analyzers: list, extension: str = 'quality_metrics'):
+    "concatenate per-unit metrics (e.g. quality_metrics, template_metrics) over analyzer parts, with `unit_id` column"
+    metrics = [
+        pl.from_pandas(analyzer.get_extension(extension).get_data().rename_axis('unit_id').reset_index())
+        for analyzer in analyzers if analyzer.has_extension(extension)
+    ]
+    if not metrics:
+        return None
+    return pl.concat(metrics, how='diagonal')
@@ -0,0 +1,223 @@
+import numpy as np
+import polars as pl
+import spikeinterface.full as si
+from pathlib import Path
+from scipy.stats import norm
+from tools.settings import settings
+from tools.spikesorting import load_recording, read_meta
+from spikeinterface.core import BaseRecording, ChunkRecordingExecutor
+
+# %% Helpers
+def get_random_chunk_slices(recording: BaseRecording, num_chunks: int = 30, chunk_duration: float = 1.0, seed: int = 0):
+    """
+    Draw non-overlapping random chunks across all recording segments.
+
+    Returns
+    -------
+    list of tuple
+        (segment_index, start_frame, end_frame) for each chunk, as used by `ChunkRecordingExecutor.run`.
+    """
+    rng = np.random.default_rng(seed)
+    chunk_size = int(chunk_duration * recording.get_sampling_frequency())
+    # candidate chunks on a fixed grid, so sampled chunks never overlap
+    candidates = [
+        (segment_index, start_frame, start_frame + chunk_size)
+        for segment_index in range(recording.get_num_segments())
+        for start_frame in range(0, recording.get_num_samples(segment_index) - chunk_size + 1, chunk_size)
+    ]
+    assert candidates, f'(!) Recording is shorter than one chunk of {chunk_duration}s'
+    picks = rng.choice(len(candidates), size=min(num_chunks, len(candidates)), replace=False)
+    return [candidates[i] for i in np.sort(picks)]
+
+def get_saturation_threshold(raw_file: Path):
+    "get ADC saturation level (raw int units) from the SpikeGLX meta file, e.g. 512 for NP1.0"
+    meta = read_meta(Path(raw_file).with_suffix('.meta'))
+    return int(meta.get('imMaxInt', 512)) - 1
+
+
+# %% functions
+def get_channel_stats(
+        recording: BaseRecording,
+        recording_slices: list | None = None,
+        saturation_threshold: int | None = None,
+        freq_min: float = 300.,
+        verbose: bool = False,
+        **job_kwargs
+):
+    """
+    Compute per-chunk channel noise and saturation counts in parallel.
+
+    If recording_slices is None, all chunks of the recording are used (full pass).
+
+    Returns
+    -------
+    noise : np.ndarray
+        (n_chunks, n_channels) noise RMS (uV) of the highpass-filtered traces.
+    saturation : np.ndarray
+        (n_chunks, n_channels) fraction of raw samples at or above saturation_threshold.
+    """
+    if saturation_threshold is None:
+        saturation_threshold = np.iinfo(recording.get_dtype()).max - 1
+    filtered = si.highpass_filter(recording, freq_min=freq_min)
+
+    # executor
+    func = _get_channel_stats_chunk
+    init_func = _init_channel_stats_chunk
+    init_args = (recording, filtered, saturation_threshold)
+    executor = ChunkRecordingExecutor(
+        recording,
+        func,
+        init_func,
+        init_args,
+        job_name='get_channel_stats',
+        verbose=verbose,
+        handle_returns=True,
+        **job_kwargs
+    )
+    results = executor.run(recording_slices=recording_slices)
+
+    noise = np.stack([res[0] for res in results])
+    saturation = np.stack([res[1] for res in results])
+    return noise, saturation
+
+def _init_channel_stats_chunk(recording: BaseRecording, filtered: BaseRecording, saturation_threshold: int):
+    # create local dict for each worker
+    worker_ctx = {}
+    worker_ctx["recording"] = recording
+    worker_ctx["filtered"] = filtered
+    worker_ctx["saturation_threshold"] = saturation_threshold
+    return worker_ctx
+
+def _get_channel_stats_chunk(
+        segment_index, start_frame, end_frame, worker_ctx):
+    "noise RMS on filtered, saturated fraction on raw traces, per channel"
+    recording = worker_ctx["recording"]
+    filtered = worker_ctx["filtered"]
+
+    traces = filtered.get_traces(start_frame=start_frame, end_frame=end_frame, segment_index=segment_index, return_scaled=True)
+    noise = np.sqrt(np.mean(traces.astype('float64') ** 2, axis=0))
+
+    raw = recording.get_traces(start_frame=start_frame, end_frame=end_frame, segment_index=segment_index)
+    saturation = np.mean(np.abs(raw.astype('int32')) >= worker_ctx["saturation_threshold"], axis=0)
+    return noise, saturation
+
+def _summarize_channel_stats(noise: np.ndarray, saturation: np.ndarray, confidence: float):
+    "mean and confidence half-width over chunks"
+    z = norm.ppf((1 + confidence) / 2)
+    n_chunks = noise.shape[0]
+    sem = lambda x: x.std(axis=0, ddof=1) / np.sqrt(n_chunks) if n_chunks > 1 else np.zeros(x.shape[1])
+    return noise.mean(axis=0), z * sem(noise), saturation.mean(axis=0), z * sem(saturation)
+
+def get_channel_qc(
+        recording: BaseRecording,
+        num_chunks: int = 30,
+        chunk_duration: float = 1.0,
+        seed: int = 0,
+        dead_threshold: float = 0.3,
+        noisy_threshold: float = 3.0,
+        saturation_threshold: int | None = None,
+        max_saturation: float = 0.001,
+        confidence: float = 0.95,
+        escalate: bool = True,
+        verbose: bool = False,
+        **job_kwargs
+):
+    """
+    Estimate channel noise RMS, dead/noisy flags and saturation fraction from random chunks.
+
+    Noise is compared to the median noise over channels: channels below dead_threshold x median
+    are flagged dead, above noisy_threshold x median noisy, and above max_saturation saturated.
+    If the confidence interval of any channel straddles one of these thresholds, that channel is
+    recomputed on a full pass over the recording (if escalate).
+
+    Returns
+    -------
+    pl.DataFrame
+        One row per channel with estimates, confidence bounds, flags, whether the sampled
+        estimate was ambiguous and whether it was recomputed on a full pass.
+    """
+    recording_slices = get_random_chunk_slices(recording, num_chunks=num_chunks, chunk_duration=chunk_duration, seed=seed)
+    noise, saturation = get_channel_stats(
+        recording, recording_slices=recording_slices, saturation_threshold=saturation_threshold,
+        verbose=verbose, **job_kwargs)
+    noise, noise_ci, saturation, saturation_ci = _summarize_channel_stats(noise, saturation, confidence)
+    print(f'Estimated channel QC from {len(recording_slices)} chunks of {chunk_duration}s')
+
+    median_noise = np.median(noise)
+    noise_thresholds = (dead_threshold * median_noise, noisy_threshold * median_noise)
+    straddles = lambda x, ci, threshold: (x - ci <= threshold) & (x + ci >= threshold)
+    ambiguous = (
+        straddles(noise, noise_ci, noise_thresholds[0])
+        | straddles(noise, noise_ci, noise_thresholds[1])
+        | straddles(saturation, saturation_ci, max_saturation)
+    )
+
+    full_pass = np.zeros_like(ambiguous)
+    if escalate and ambiguous.any():
+        channel_ids = recording.channel_ids[ambiguous]
+        print(f'...{len(channel_ids)} ambiguous channels, running full pass: {list(channel_ids)}')
+        full_noise, full_saturation = get_channel_stats(
+            recording.channel_slice(channel_ids=channel_ids), saturation_threshold=saturation_threshold,
+            verbose=verbose, **job_kwargs)
+        noise[ambiguous] = full_noise.mean(axis=0)
+        saturation[ambiguous] = full_saturation.mean(axis=0)
+        noise_ci[ambiguous] = 0.
+        saturation_ci[ambiguous] = 0.
+        full_pass = ambiguous
+
+    return pl.DataFrame(dict(
+        channel_id=[str(ch) for ch in recording.channel_ids],
+        channel_idx=np.arange(recording.get_num_channels()),
+        noise_rms=noise,
+        noise_rms_lower=noise - noise_ci,
+        noise_rms_upper=noise + noise_ci,
+        saturation_fraction=saturation,
+        saturation_fraction_lower=np.clip(saturation - saturation_ci, 0, 1),
+        saturation_fraction_upper=np.clip(saturation + saturation_ci, 0, 1),
+        dead=noise < noise_thresholds[0],
+        noisy=noise > noise_thresholds[1],
+        saturated=saturation > max_saturation,
+        ambiguous=ambiguous,
+        full_pass=full_pass,
+    ))
+
+def get_recording_qc(
+        raw_file: Path,
+        rec_folder: Path,
+        probe_num: int,
+        overwrite: bool = False,
+        concatenate: bool = False,
+        qc_kwargs: dict = dict(num_chunks=30, chunk_duration=1.0),
+        qc_job_kwargs: dict = dict(n_jobs=8, progress_bar=True)
+):
+    """
+    Run channel QC for one probe and save to '<processed_dir>/metrics/<session>_channel_qc_probe<N>.csv'.
+
+    Loads the existing QC table unless overwrite.
+    """
+    global settings
+    processed_dir = settings.paths.processed_dir
+    assert f'imec{probe_num}' in raw_file.name, f"(!) Expected imec{probe_num} in {raw_file.name}\nSkipping...\n\n"
+
+    metrics_folder = rec_folder / processed_dir / 'metrics'
+    metrics_folder.mkdir(parents=True, exist_ok=True)
+    qc_file = metrics_folder / f'{rec_folder.name}_channel_qc_probe{probe_num}.csv'
+    if not overwrite and qc_file.exists():
+        print(f'Loaded existing channel QC from {qc_file}')
+        return pl.read_csv(qc_file)
+
+    rec = load_recording(raw_file, concatenate=concatenate, as_segments=concatenate)
+    if rec is None:
+        print(f'(!) No valid recording found for probe {probe_num} in {raw_file.stem}\nSkipping...\n\n')
+        return None
+
+    qc_kwargs = dict(qc_kwargs)
+    qc_kwargs.setdefault('saturation_threshold', get_saturation_threshold(raw_file))
+    channel_qc = get_channel_qc(rec, **qc_kwargs, **qc_job_kwargs)
+    channel_qc.write_csv(qc_file)
+    print(
+        f'Channel QC for probe {probe_num}: {channel_qc["dead"].sum()} dead, '
+        f'{channel_qc["noisy"].sum()} noisy, {channel_qc["saturated"].sum()} saturated channels'
+    )
+    print(f'Saved channel QC to {qc_file}')
+    return channel_qc
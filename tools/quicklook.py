@@ -0,0 +1,157 @@
+import numpy as np
+import polars as pl
+import matplotlib.pyplot as plt
+from pathlib import Path
+from tools.settings import settings
+
+# %% Helpers
+def bin_spikes(
+        session_spiking: pl.DataFrame,
+        width: int = 2000,
+        height: int | None = None,
+        depth_col: str = 'unit_y',
+        t_range: tuple | None = None,
+        fallback_range: tuple | None = None
+):
+    """
+    Bin all spikes of a session into a fixed (units x time) pixel grid of firing rates.
+
+    Units are sorted by depth_col (falls back to `original_channel_idx`), one row per unit unless
+    height is given. Spikes are counted with a single bincount, so rendering the grid afterwards
+    does not depend on the number of spikes. t_range defaults to the spike time span; if that is
+    empty (no or a single spike), fallback_range (e.g. the sync span) or 1 sec is used.
+
+    Returns
+    -------
+    rates : np.ndarray
+        (rows, width) firing rate (Hz) per unit row and time bin.
+    t_edges : np.ndarray
+        Time bin edges (secs).
+    depths : np.ndarray
+        Depth of each unit, in row order.
+    """
+    if depth_col not in session_spiking.columns:
+        depth_col = 'original_channel_idx'
+    units = session_spiking.select(['unit_id', depth_col, 'spike_times_sec']).sort(depth_col)
+    n_units = units.height
+    height = max(n_units if height is None else height, 1)
+
+    spikes = (
+        units.with_row_index('unit_rank').select(['unit_rank', 'spike_times_sec'])
+        .explode('spike_times_sec').drop_nulls('spike_times_sec').filter(pl.col('spike_times_sec').is_not_nan())
+    )
+    ranks = spikes['unit_rank'].to_numpy()
+    times = spikes['spike_times_sec'].to_numpy()
+    if t_range is None and len(times):
+        t_range = (times.min(), times.max())
+    if t_range is None or not t_range[1] > t_range[0]:  # empty span, e.g. a single spike
+        if fallback_range is not None and fallback_range[1] > fallback_range[0]:
+            t_range = fallback_range
+        else:
+            t0 = t_range[0] if t_range is not None else 0.
+            t_range = (t0, t0 + 1.)
+    t_edges = np.linspace(t_range[0], t_range[1], width + 1)
+
+    cols = np.floor((times - t_range[0]) / (t_edges[1] - t_edges[0])).astype(np.int64)
+    cols[times == t_range[1]] = width - 1  # last bin includes its right edge, e.g. the latest spike
+    valid = (cols >= 0) & (cols < width)
+    rows = ranks[valid].astype(np.int64) * height // max(n_units, 1)
+    counts = np.bincount(rows * width + cols[valid], minlength=height * width).reshape(height, width)
+
+    units_per_row = np.bincount(np.arange(n_units) * height // max(n_units, 1), minlength=height).clip(min=1)
+    rates = counts / units_per_row[:, None] / (t_edges[1] - t_edges[0])
+    return rates, t_edges, units[depth_col].to_numpy()
+
+
+# %% functions
+def plot_quicklook(
+        session_spiking: pl.DataFrame,
+        ping_times: np.ndarray | None = None,
+        filename: Path | None = None,
+        title: str = '',
+        width: int = 2000,
+        depth_col: str = 'unit_y',
+        max_percentile: float = 99.
+):
+    """
+    Plot a whole-session rate map (units by depth x time) with the sync event train above.
+
+    Saved to filename if given (png), otherwise the figure is returned.
+    """
+    sync_range = (np.min(ping_times), np.max(ping_times)) if ping_times is not None and len(ping_times) else None
+    rates, t_edges, depths = bin_spikes(session_spiking, width=width, depth_col=depth_col, fallback_range=sync_range)
+
+    fig, (ax_sync, ax_rates) = plt.subplots(
+        2, 1, figsize=(12, 6), dpi=200, sharex=True, gridspec_kw=dict(height_ratios=[1, 12])
+    )
+    # sync events, binned to the same time grid
+    if ping_times is not None and len(ping_times):
+        ping_counts, _ = np.histogram(ping_times, bins=t_edges)
+        ax_sync.fill_between(t_edges[:-1], ping_counts, step='post', color='k', linewidth=0)
+    ax_sync.set_ylabel('sync', rotation=0, ha='right', va='center')
+    ax_sync.set_yticks([])
+    ax_sync.set_title(title)
+
+    vmax = np.percentile(rates[rates > 0], max_percentile) if (rates > 0).any() else 1
+    im = ax_rates.imshow(
+        rates, aspect='auto', origin='lower', cmap='binary', vmin=0, vmax=vmax, interpolation='none',
+        extent=(t_edges[0], t_edges[-1], 0, rates.shape[0])
+    )
+    ax_rates.set_xlabel('time (s)')
+    ax_rates.set_ylabel(f'units (sorted by {depth_col})')
+    fig.colorbar(im, ax=[ax_sync, ax_rates], label='firing rate (Hz)', fraction=0.02, pad=0.01)
+
+    if filename is None:
+        return fig
+    fig.savefig(filename, dpi=200, bbox_inches='tight')
+    plt.close(fig)
+    print(f'...saved quick-look plot to:\n\t{filename}')
+    return filename
+
+def plot_session_quicklooks(rec_folder: Path, overwrite: bool = False, **plot_kwargs):
+    """
+    Plot quick-looks for all spiking outputs of a session.
+
+    Reads '<output_dir>/<session>_units_spiking_probe<N>.parquet' and 'ping_times_probe<N>.npy',
+    and writes '<output_dir>/plots/<session>_probe<N>_quicklook.png'.
+    """
+    global settings
+    data_output = rec_folder / settings.paths.output_dir
+    plots_folder = data_output / 'plots'
+    plots_folder.mkdir(parents=True, exist_ok=True)
+
+    plot_files = []
+    for spiking_file in sorted(data_output.glob(f'{rec_folder.name}_units_spiking_probe*.parquet')):
+        probe_num = spiking_file.stem.split('_probe')[-1]
+        plot_file = plots_folder / f'{rec_folder.name}_probe{probe_num}_quicklook.png'
+        if not overwrite and plot_file.exists():
+            print(f'...skipping existing quick-look plot:\n\t{plot_file}')
+            plot_files.append(plot_file)
+            continue
+
+        session_spiking = pl.read_parquet(spiking_file)
+        ping_file = data_output / f'ping_times_probe{probe_num}.npy'
+        ping_times = np.load(ping_file) if ping_file.exists() else None
+        if ping_times is None:
+            print(f'(!) No sync timestamps found for probe {probe_num} in {rec_folder.name}, plotting spikes only')
+        plot_files.append(plot_quicklook(
+            session_spiking,
+            ping_times=ping_times,
+            filename=plot_file,
+            title=f'{rec_folder.name} probe {probe_num} ({session_spiking.height} units)',
+            **plot_kwargs
+        ))
+    if not plot_files:
+        print(f'(!) No spiking data found for {rec_folder.name} in {data_output}')
+    return plot_files
+
+def plot_all_quicklooks(batch_folder: Path, recording_pairs: dict, overwrite: bool = False, **plot_kwargs):
+    "plot quick-looks for all sessions in recording_pairs (e.g. `settings.experiment.recordings`)"
+    for session in recording_pairs:
+        rec_folder = batch_folder / session.split('_')[0] / session
+        if not rec_folder.exists():
+            print(f'(!) No recording session folder found for:  {rec_folder}\nSkipping...\n\n')
+            continue
+        print(f'---plotting  {session}')
+        plot_session_quicklooks(rec_folder, overwrite=overwrite, **plot_kwargs)
+    print('\nFinished plotting all recordings.'.upper())
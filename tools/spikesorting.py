@@ -1,8 +1,233 @@
+import re
+import json
+import zarr
+import hashlib
+import numpy as np
+import probeinterface
 import spikeinterface.full as si
 from pathlib import Path
+from functools import lru_cache
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+from spikeinterface.extractors.neuropixels_utils import get_neuropixels_sample_shifts
+
+# %% segment helpers
+# SpikeGLX names each recording segment '<run>_g<gate>_t<trigger>.imec<probe>.ap.<ext>'
+SEGMENT_PATTERN = re.compile(r'_g(?P<gate>\d+)(?:_t(?P<trigger>\d+))?')
+PROBE_PATTERN = re.compile(r'imec(?P<probe>\d+)')
+
+def parse_segment_name(filepath: Path):
+    """
+    Get gate, trigger and probe indices from a SpikeGLX file name.
+
+    Missing indices are returned as 0, so single-segment recordings sort first.
+    """
+    name = Path(filepath).name
+    segment = SEGMENT_PATTERN.search(name)
+    probe = PROBE_PATTERN.search(name)
+    return dict(
+        gate=int(segment['gate']) if segment else 0,
+        trigger=int(segment['trigger']) if segment and segment['trigger'] else 0,
+        probe=int(probe['probe']) if probe else 0,
+    )
+
+def sort_segment_files(raw_files: list):
+    "order recording segments by gate, then trigger index (instead of filesystem order)"
+    def _key(f):
+        info = parse_segment_name(f)
+        return (info['gate'], info['trigger'], Path(f).name)
+    return sorted(raw_files, key=_key)
+
+def _is_hidden(filepath: Path, folder: Path):
+    "dot-prefixed file or folder below folder, e.g. partial outputs of `tools.work_queue.atomic_output`"
+    return any(part.startswith('.') for part in filepath.relative_to(folder).parts)
+
+def _find_raw_files(folder: Path, patterns: str | tuple):
+    """
+    Files matching any of patterns (recursive), skipping hidden paths.
+
+    One file per segment: if a segment is stored in several formats (e.g. '.cbin' and '.zarr'),
+    the file matching the earlier pattern is kept.
+    """
+    raw_files = {}
+    for pattern in ([patterns] if isinstance(patterns, str) else patterns):
+        for f in folder.rglob(pattern):
+            if not _is_hidden(f, folder):
+                raw_files.setdefault(f.with_suffix(''), f)
+    return list(raw_files.values())
+
+def find_segment_files(folder: Path, probe_num: int | None = None, pattern: str | tuple = '*.cbin'):
+    "find all segment files in folder (recursive), optionally for a single probe, in gate/trigger order"
+    raw_files = _find_raw_files(folder, pattern)
+    if probe_num is not None:
+        raw_files = [f for f in raw_files if parse_segment_name(f)['probe'] == probe_num]
+    return sort_segment_files(raw_files)
+
+def get_probe_files(raw_folder: Path, recording_name: str = '', pattern: str | tuple = ('*imec*.cbin', '*imec*.zarr')):
+    """
+    Group raw files in raw_folder by probe number; segments in gate/trigger order.
+
+    Finds '.cbin' and '.zarr' (see `tools.compression.compress_recording_zarr`) recordings by default.
+    """
+    patterns = [pattern] if isinstance(pattern, str) else pattern
+    probe_files = {}
+    raw_files = _find_raw_files(raw_folder, tuple(f'{recording_name}{p}' for p in patterns))
+    for raw_file in sort_segment_files(raw_files):
+        probe_files.setdefault(parse_segment_name(raw_file)['probe'], []).append(raw_file)
+    return dict(sorted(probe_files.items()))
+
+def read_meta(meta_file: Path):
+    "read SpikeGLX '.meta' file into a dict of strings"
+    meta = {}
+    with open(meta_file, 'r') as f:
+        for line in f:
+            key, sep, value = line.strip().partition('=')
+            if sep:
+                meta[key.lstrip('~')] = value
+    return meta
+
+def get_sync_channel_indices(meta: dict):
+    "indices of the sync channels among the saved channels, SpikeGLX saves them last (counts in `snsApLfSy`)"
+    n_saved = int(meta['nSavedChans'])
+    n_sync = int(meta['snsApLfSy'].split(',')[-1])
+    return list(range(n_saved - n_sync, n_saved))
+
+def set_spikeglx_probe(rec: BaseRecording, meta_file: Path):
+    """
+    Attach probe geometry and inter-sample shifts from a SpikeGLX '.meta' file to rec (without sync channels).
+
+    Same as `si.read_spikeglx` does, for recordings not read by it (e.g. zarr, see `ZarrChannelRecording`).
+    """
+    probe = probeinterface.read_spikeglx(meta_file)
+    group_mode = 'by_shank' if probe.shank_ids is not None else 'by_probe'
+    rec = rec.set_probe(probe, group_mode=group_mode)
+
+    # ADC multiplexing depends on probe type, shifts are defined for all 384 channels
+    model_name = probe.annotations.get('model_name') or probe.annotations.get('probe_name', '')
+    if '2.0' in model_name:
+        sample_shifts = get_neuropixels_sample_shifts(384, num_channels_per_adc=16, num_cycles=16)
+    else:
+        sample_shifts = get_neuropixels_sample_shifts(384, num_channels_per_adc=12, num_cycles=13)
+    channels = probeinterface.get_saved_channel_indices_from_spikeglx_meta(meta_file)
+    rec.set_property('inter_sample_shift', sample_shifts[channels[channels < 384]])
+    return rec
+
+@lru_cache(maxsize=None)
+def _get_segment_info(meta_file: Path, mtime: float):
+    meta = read_meta(meta_file)
+    n_channels = int(meta['nSavedChans'])
+    fs = float(meta['imSampRate'])
+    num_samples = int(meta['fileSizeBytes']) // (2 * n_channels)  # int16 samples
+    return dict(num_samples=num_samples, sampling_frequency=fs, num_channels=n_channels)
+
+def get_segment_info(raw_file: Path):
+    """
+    Get number of samples, sampling frequency and channel count for a recording segment.
+
+    Read from the SpikeGLX '.meta' file next to the '.cbin'/'.bin' file, so no data is decompressed.
+    Results are cached per file (and modification time).
+    """
+    meta_file = Path(raw_file).with_suffix('.meta')
+    assert meta_file.exists(), f'(!) No meta file found for {raw_file}'
+    return dict(_get_segment_info(meta_file, meta_file.stat().st_mtime))
+
+def get_segment_table(raw_files: list, recording: si.BaseRecording | None = None):
+    """
+    Build global sample/time offset table for the recording segments in raw_files.
+
+    Segments are ordered by gate/trigger index, as in `load_recording(concatenate=True)`, so
+    `sample_offset` maps segment-local samples onto the concatenated recording (and sorting).
+    If recording (multi-segment, see `load_recording(as_segments=True)`) is given, offsets use
+    the sample counts of the segments actually loaded, which must match raw_files one to one.
+
+    Returns
+    -------
+    list of dict
+        One entry per segment with file, gate, trigger, num_samples, sampling_frequency,
+        sample_offset and time_offset (secs).
+    """
+    raw_files = sort_segment_files(raw_files)
+    if recording is not None:
+        assert recording.get_num_segments() == len(raw_files), (
+            f'(!) {recording.get_num_segments()} segments loaded for {len(raw_files)} files, '
+            f'cannot map segments to files: {[Path(f).name for f in raw_files]}'
+        )
+    segment_table = []
+    sample_offset = 0
+    for segment_index, raw_file in enumerate(raw_files):
+        info = get_segment_info(raw_file)
+        if recording is not None:
+            if (num_samples := recording.get_num_samples(segment_index)) != info['num_samples']:
+                print(f'(!) {Path(raw_file).name}: {num_samples} samples loaded, {info["num_samples"]} in meta file')
+            info['num_samples'] = num_samples
+        segment_table.append(dict(
+            file=Path(raw_file).name,
+            **{k: v for k, v in parse_segment_name(raw_file).items() if k != 'probe'},
+            **info,
+            sample_offset=sample_offset,
+            time_offset=sample_offset / info['sampling_frequency'],
+        ))
+        sample_offset += info['num_samples']
+    return segment_table
+
+
+# %% zarr recordings
+# spikeinterface checks the top-level module version when reloading recordings (e.g. in workers),
+# this module is top-level when installed (see pyproject.toml)
+__version__ = '0.1.0'
+
+class ZarrChannelRecording(BaseRecording):
+    """
+    Recording stored as (channels, time) zarr arrays, see `tools.compression.compress_recording_zarr`.
+
+    Each segment is a 'traces_seg<i>' array chunked by channel groups and time. Reads index the
+    array directly (`oindex[channels, start:end]`), so only chunks of the requested channels and
+    time range are decoded.
+    """
+    def __init__(self, folder_path: Path | str):
+        root = zarr.open_group(str(folder_path), mode='r')
+        attrs = root.attrs.asdict()
+        BaseRecording.__init__(
+            self,
+            sampling_frequency=attrs['sampling_frequency'],
+            channel_ids=attrs['channel_ids'],
+            dtype=root['traces_seg0'].dtype,
+        )
+        for segment_index in range(attrs['num_segments']):
+            self.add_recording_segment(ZarrChannelRecordingSegment(
+                root[f'traces_seg{segment_index}'], attrs['sampling_frequency']))
+        if attrs['gain_to_uV'] is not None:
+            self.set_channel_gains(attrs['gain_to_uV'])
+            self.set_channel_offsets(attrs['offset_to_uV'])
+        self._kwargs = dict(folder_path=str(Path(folder_path).resolve()))
+
+class ZarrChannelRecordingSegment(BaseRecordingSegment):
+    def __init__(self, traces: zarr.Array, sampling_frequency: float):
+        BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
+        self._traces = traces
+
+    def get_num_samples(self):
+        return self._traces.shape[1]
+
+    def get_traces(self, start_frame=None, end_frame=None, channel_indices=None):
+        if channel_indices is None:
+            channel_indices = slice(None)
+        elif not isinstance(channel_indices, slice):
+            channel_indices = np.asarray(channel_indices)
+        traces = self._traces.oindex[channel_indices, start_frame:end_frame]
+        return np.ascontiguousarray(traces.T)  # (time, channels)
+
 
 # %% helper functions
 def load_raw_recording(filepath: Path, include_sync: bool=False):
+    if filepath.suffix == '.zarr':  # see `tools.compression.compress_recording_zarr`, includes sync channel
+        rec = ZarrChannelRecording(filepath)
+        if include_sync:
+            return rec
+        # '.meta' copied next to the zarr folder, defines sync channels and probe
+        meta_file = filepath.with_suffix('.meta')
+        sync_indices = get_sync_channel_indices(read_meta(meta_file))
+        rec = rec.channel_slice(channel_ids=[ch for i, ch in enumerate(rec.channel_ids) if i not in sync_indices])
+        return set_spikeglx_probe(rec, meta_file)
     try:
         return si.read_cbin_ibl(cbin_file_path=filepath, load_sync_channel=include_sync, stream_name='ap')
     except StopIteration:
@@ -13,14 +238,29 @@ def load_raw_recording(filepath: Path, include_sync: bool=False):
             print(f'Issues loading raw recording for {filepath}\nSkipping...\n\n')
             return None
 
-def load_recording(filepath: Path=None, folder: Path=None, concatenate: bool = False, include_sync: bool=False):
+def load_recording(
+        filepath: Path=None,
+        folder: Path=None,
+        concatenate: bool = False,
+        include_sync: bool=False,
+        as_segments: bool = False
+):
+    """
+    Load raw recording, optionally concatenating all segments of the same probe.
+
+    Segments are ordered by gate/trigger index. If as_segments, segments are kept as a
+    multi-segment recording (`si.append_recordings`) instead of concatenated, e.g. to process
+    segments in parallel; map back to the concatenated timebase with `get_segment_table`.
+    """
     if folder is None:
         folder = filepath.parent
     if not concatenate:
         return load_raw_recording(filepath=filepath, include_sync=include_sync)
     else:  # load and concatenate recording segments
         recs = []
-        raw_files = list(folder.rglob('*.cbin'))
+        probe_num = parse_segment_name(filepath)['probe'] if filepath is not None else None
+        pattern = f'*{filepath.suffix}' if filepath is not None else ('*.cbin', '*.zarr')
+        raw_files = find_segment_files(folder, probe_num=probe_num, pattern=pattern)
         for i, raw_file in enumerate(raw_files):
             rec = load_raw_recording(raw_file, include_sync=include_sync)
             if rec is not None:
@@ -28,10 +268,121 @@ def load_recording(filepath: Path=None, folder: Path=None, concatenate: bool = F
         if not recs:
             print(f'No valid recordings found for {folder}\nSkipping...\n\n')
             return None
+        if as_segments:
+            return si.append_recordings(recs)
         return si.concatenate_recordings(recs)
 
 
 # %% processing functions
-def process_recording(rec: si.BaseRecording, probe_num: int):
-    # TODO: implement processing pipeline
-    pass
\ No newline at end of file
+# preprocessing chain, applied in order as `si.<step>(rec, **params)`
+default_preprocessing_params = dict(
+    phase_shift=dict(),
+    highpass_filter=dict(freq_min=300.),
+    common_reference=dict(reference='global', operator='median'),
+)
+
+def get_source_files(rec: si.BaseRecording):
+    "files/folders the recording reads from (e.g. '.cbin' of each segment), from its serialized kwargs"
+    source_files = []
+    def _walk(value, key=''):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                _walk(v, k)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                _walk(v, key)
+        elif isinstance(value, (str, Path)) and ('path' in key or 'file' in key) and Path(value).exists():
+            source_files.append(Path(value))
+    _walk(rec.to_dict(recursive=True))
+    return source_files
+
+def get_source_probe(rec: si.BaseRecording):
+    "imec probe number of the files rec reads from (see `parse_segment_name`), None if not in their names"
+    probes = {parse_segment_name(f)['probe'] for f in get_source_files(rec) if PROBE_PATTERN.search(f.name)}
+    assert len(probes) <= 1, f'(!) Recording reads from several probes: {sorted(probes)}'
+    return probes.pop() if probes else None
+
+def get_preprocessing_key(rec: si.BaseRecording, preprocessing_params: dict):
+    """
+    Short hash of the preprocessing chain and the source recording, used to key the cache.
+
+    The source is described by its layout and the names and modification times of the files it
+    reads, so re-compressed or swapped segments get a new cache.
+    """
+    source = dict(
+        channel_ids=[str(ch) for ch in rec.channel_ids],
+        num_samples=[rec.get_num_samples(i) for i in range(rec.get_num_segments())],
+        sampling_frequency=rec.get_sampling_frequency(),
+        files=[[f.name, f.stat().st_mtime] for f in get_source_files(rec)],
+    )
+    # chain as list of steps, so step order is part of the key
+    chain = [[step, params] for step, params in preprocessing_params.items()]
+    key = json.dumps(dict(chain=chain, source=source), sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:10]
+
+def build_preprocessing_chain(rec: si.BaseRecording, preprocessing_params: dict = default_preprocessing_params):
+    "lazily apply preprocessing steps to rec"
+    for step, params in preprocessing_params.items():
+        if step == 'phase_shift' and rec.get_property('inter_sample_shift') is None:
+            print('...no inter-sample shift for recording, skipping phase_shift')
+            continue
+        rec = getattr(si, step)(rec, **params)
+    return rec
+
+def load_processed_recording(processed_folder: Path, probe_num: int, key: str | None = None):
+    """
+    Load cached preprocessed recording for probe from processed_folder (memmapped binary).
+
+    If key is None, the most recently written cache for the probe is loaded.
+    Returns None if no cache is found.
+    """
+    pattern = f'preprocessed_probe{probe_num}_{key if key else "*"}'
+    cached = [f for f in processed_folder.glob(pattern) if (f / 'preprocessing_params.json').exists()]
+    if not cached:
+        return None
+    cache_folder = max(cached, key=lambda f: (f / 'preprocessing_params.json').stat().st_mtime)
+    print(f'Loaded preprocessed recording from "{cache_folder}"')
+    return si.load(cache_folder)
+
+def process_recording(
+        rec: si.BaseRecording,
+        probe_num: int | None,
+        processed_folder: Path,
+        preprocessing_params: dict = default_preprocessing_params,
+        overwrite: bool = False,
+        job_kwargs: dict = dict(n_jobs=8, chunk_duration='1s', progress_bar=True)
+):
+    """
+    Preprocess recording once and cache it as a memmappable binary folder.
+
+    The cache is written (in parallel chunks) to '<processed_folder>/preprocessed_probe<N>_<key>',
+    where key hashes the preprocessing parameters and the source recording, so any change to
+    the chain writes a new cache and an unchanged chain reuses the existing one.
+    N is the imec probe number (as in `get_probe_files`), taken from the source file names and
+    checked against probe_num, so caches never mix up probes.
+
+    Returns
+    -------
+    si.BaseRecording
+        Binary folder recording, read with plain memmap reads downstream.
+    """
+    if (source_probe := get_source_probe(rec)) is not None:
+        assert probe_num is None or probe_num == source_probe, (
+            f'(!) probe_num {probe_num} does not match source files of imec{source_probe}, '
+            'pass the imec probe number (see `get_probe_files`)'
+        )
+        probe_num = source_probe
+    assert probe_num is not None, '(!) No imec probe number in source file names, pass probe_num'
+    key = get_preprocessing_key(rec, preprocessing_params)
+    cache_folder = processed_folder / f'preprocessed_probe{probe_num}_{key}'
+    if not overwrite and (cached_rec := load_processed_recording(processed_folder, probe_num, key=key)) is not None:
+        return cached_rec
+
+    print(f'...preprocessing probe {probe_num}: {list(preprocessing_params)}')
+    processed_rec = build_preprocessing_chain(rec, preprocessing_params)
+    processed_rec = processed_rec.save(folder=cache_folder, format='binary', overwrite=True, **job_kwargs)
+    # written last, marks the cache as complete
+    with open(cache_folder / 'preprocessing_params.json', 'w') as f:
+        json.dump(preprocessing_params, f, indent=4, default=str)
+    print(f'Saved preprocessed recording to "{cache_folder}"')
+    return processed_rec
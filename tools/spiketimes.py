@@ -4,7 +4,7 @@ from pathlib import Path
 from spikeinterface.core import BaseRecording, ChunkRecordingExecutor
 
 # %% Helpers
-def load_alignment_data(filename: Path):
+def load_alignment_data(filename: Path, recording_name: str | None = None, probe_num: int | None = None):
     """
     Load alignment table with unit->channelid->brain region info.
 
@@ -12,8 +12,17 @@ def load_alignment_data(filename: Path):
     ----------
     filename : Path
         Path to the alignment data file to load.
+    recording_name : str, optional
+        Only keep units for this recording.
+    probe_num : int, optional
+        Only keep units for this probe.
     """
-    pass
+    alignment_df = pl.read_csv(filename)
+    if recording_name is not None:
+        alignment_df = alignment_df.filter(pl.col('recording_name') == recording_name)
+    if probe_num is not None:
+        alignment_df = alignment_df.filter(pl.col('probe_id') == probe_num)
+    return alignment_df
 
 def get_rec_spikes():
     'get spikes for duration of recording, start stop ideally from sync signal'
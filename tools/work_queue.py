@@ -0,0 +1,252 @@
+"""work_queue.py
+File-lock work queue, so several machines can process the same experiment on a shared drive.
+
+Each task (e.g. one session/probe) is claimed by atomically creating a lock file holding the
+host, PID and a token; a heartbeat touches the lock file while the task runs. Locks not touched
+for `stale_after` secs (or whose process is gone, on the same host) are reclaimed. A worker that
+loses its claim is flagged (`TaskClaim.lost`) and can no longer commit outputs, which are written
+with atomic renames (`atomic_output`) so readers never see partial files. Finished tasks leave a
+'.done' marker (`TaskClaim.mark_done`).
+"""
+import os
+import json
+import time
+import socket
+import shutil
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+HOST = socket.gethostname()
+
+# %% helpers
+def _read_lock(lock_file: Path):
+    try:
+        with open(lock_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _write_lock(lock_file: Path, claim: dict):
+    "write claim (e.g. '.done' marker) with an atomic replace"
+    tmp_file = lock_file.with_name(f'.{lock_file.name}.{HOST}.{os.getpid()}.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(claim, f)
+    os.replace(tmp_file, lock_file)
+
+def _process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # e.g. no permission, process exists
+        return True
+    return True
+
+def _lock_age(lock_file: Path):
+    "secs since the lock file was last touched, None if it is gone"
+    try:
+        return time.time() - lock_file.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+def is_stale(claim: dict | None, lock_file: Path, stale_after: float):
+    """
+    Claim is stale if its lock file was not touched (heartbeat) for stale_after secs, or its
+    process is gone (same host only). Unreadable claims (e.g. empty lock files) go by age only.
+    """
+    if claim is not None and claim['host'] == HOST and not _process_alive(claim['pid']):
+        return True
+    age = _lock_age(lock_file)
+    return age is None or age > stale_after
+
+def _try_create_lock(lock_file: Path, claim: dict):
+    "atomically create lock file, False if it already exists"
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump(claim, f)
+    return True
+
+def _restore_lock(tombstone: Path, lock_file: Path, claim: dict | None):
+    "put a live lock moved to tombstone back, unless another worker created a new lock since"
+    try:
+        os.link(tombstone, lock_file)  # never replaces an existing lock
+    except FileExistsError:
+        pass
+    except OSError:  # no hard links on this drive (e.g. exFAT, SMB mounts), fall back to rename
+        try:
+            if not lock_file.exists():
+                os.rename(tombstone, lock_file)
+        except OSError:
+            pass
+        else:
+            current = _read_lock(lock_file)
+            if claim is not None and (current is None or current['token'] != claim['token']):
+                print(f'(!) Could not restore lock {lock_file.name}, replaced by another worker')
+    finally:
+        tombstone.unlink(missing_ok=True)
+
+def _heartbeat(task: 'TaskClaim', interval: float, stop: threading.Event):
+    "touch the lock file while it holds our token, otherwise flag the claim as lost"
+    missing = 0
+    while not stop.wait(interval):
+        current = _read_lock(task.lock_file)
+        if current is None and task.lock_file.exists():
+            continue  # being written, check again next beat
+        # a missing lock can be a reclaim check putting it back, only give up if it stays gone
+        missing = missing + 1 if current is None else 0
+        if (current is not None and current['token'] != task.claim['token']) or missing > 1:
+            task.lost.set()
+            print(f'(!) Lost claim on {task.task_name} (reclaimed by {current["host"] if current else "unknown"})')
+            return
+        if current is not None:
+            try:  # refresh mtime only, never rewrites another worker's lock
+                os.utime(task.lock_file)
+            except FileNotFoundError:
+                pass
+
+class TaskClaim:
+    """
+    Claim on a task, see `claim_task`; truthy while held.
+
+    `lost` is set once another worker reclaimed the task. Outputs are only committed while the
+    claim is held (`atomic_output(target, claim=...)`), and `mark_done` is called once they exist.
+    Claims without a queue (lock_file None) are always held, for single-machine runs.
+    """
+    def __init__(self, task_name: str, lock_file: Path | None = None, done_file: Path | None = None,
+                 claim: dict | None = None, held: bool = True):
+        self.task_name = task_name
+        self.lock_file = lock_file
+        self.done_file = done_file
+        self.claim = claim
+        self.held = held
+        self.lost = threading.Event()
+
+    def __bool__(self):
+        return self.held and not self.lost.is_set()
+
+    def still_held(self):
+        "check the lock file still holds our token (flags the claim as lost otherwise)"
+        if not self or self.lock_file is None:
+            return bool(self)
+        current = _read_lock(self.lock_file)
+        if current is None or current['token'] != self.claim['token']:
+            self.lost.set()
+            return False
+        return True
+
+    def mark_done(self):
+        "write the '.done' marker, if the claim is still held"
+        if self.lock_file is None:
+            return bool(self)
+        if not self.still_held():
+            print(f'(!) Lost claim on {self.task_name}, not marking done')
+            return False
+        _write_lock(self.done_file, dict(self.claim, finished=time.time()))
+        return True
+
+
+# %% functions
+@contextmanager
+def claim_task(
+        queue_folder: Path | None,
+        task_name: str,
+        overwrite: bool = False,
+        stale_after: float = 600.,
+        heartbeat_interval: float = 30.
+):
+    """
+    Claim a task for this process, yielding a `TaskClaim` that is truthy if claimed.
+
+    Not claimed if the task is already done (unless overwrite) or claimed by a live worker.
+    The task is only marked done by `claimed.mark_done()`, once its outputs were written; the
+    lock is always released. If queue_folder is None, the task is claimed without a lock file.
+
+    Example
+    -------
+    with claim_task(queue_folder, f'{recording_name}_probe{probe_num}') as claimed:
+        if not claimed:
+            continue
+        with atomic_output(out_file, claim=claimed) as tmp_file:
+            ...
+        claimed.mark_done()
+    """
+    if queue_folder is None:
+        yield TaskClaim(task_name)
+        return
+    queue_folder.mkdir(parents=True, exist_ok=True)
+    lock_file = queue_folder / f'{task_name}.lock'
+    done_file = queue_folder / f'{task_name}.done'
+    if done_file.exists() and not overwrite:
+        print(f'...{task_name} already done ({(_read_lock(done_file) or {}).get("host", "unknown host")}), skipping')
+        yield TaskClaim(task_name, held=False)
+        return
+
+    token = f'{HOST}:{os.getpid()}:{time.time_ns()}'
+    claim = dict(host=HOST, pid=os.getpid(), token=token, claimed=time.time())
+    if not _try_create_lock(lock_file, claim):
+        current = _read_lock(lock_file)
+        owner = f'{current["host"]} (pid {current["pid"]})' if current else 'another worker'
+        if not is_stale(current, lock_file, stale_after):
+            print(f'...{task_name} claimed by {owner}, skipping')
+            yield TaskClaim(task_name, held=False)
+            return
+        # reclaim: only one worker wins the rename of the stale lock
+        tombstone = lock_file.with_name(f'.{lock_file.name}.stale.{token.replace(":", "_")}')
+        try:
+            os.rename(lock_file, tombstone)
+        except FileNotFoundError:
+            pass
+        else:
+            # rename keeps the mtime, so a lock touched since we checked it is not stale anymore
+            if not is_stale(moved := _read_lock(tombstone), tombstone, stale_after):
+                _restore_lock(tombstone, lock_file, moved)
+                print(f'...{task_name} claimed by {moved["host"] if moved else "another worker"}, skipping')
+                yield TaskClaim(task_name, held=False)
+                return
+            tombstone.unlink()
+        if not _try_create_lock(lock_file, claim):
+            print(f'...{task_name} reclaimed by another worker, skipping')
+            yield TaskClaim(task_name, held=False)
+            return
+        print(f'...reclaimed stale claim on {task_name} from {owner}')
+
+    print(f'...claimed {task_name} on {HOST} (pid {os.getpid()})')
+    task = TaskClaim(task_name, lock_file=lock_file, done_file=done_file, claim=claim)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(task, heartbeat_interval, stop), daemon=True)
+    heartbeat.start()
+    try:
+        yield task
+    finally:
+        stop.set()
+        heartbeat.join()
+        if (current := _read_lock(lock_file)) is not None and current['token'] == token:
+            lock_file.unlink(missing_ok=True)
+
+@contextmanager
+def atomic_output(target: Path, claim: TaskClaim | None = None):
+    """
+    Yield a temporary path next to target, renamed to target on success.
+
+    The temporary name keeps target's suffix (e.g. for `np.save`) behind a leading dot, so
+    `tools.spikesorting.find_segment_files` skips it, and is removed on errors.
+    Folder outputs (e.g. zarr) replace an existing target folder.
+    If claim is given (see `claim_task`), target is only written while the claim is held.
+    """
+    target = Path(target)
+    tmp_file = target.with_name(f'.{target.stem}.{HOST}.{os.getpid()}.tmp{target.suffix}')
+    try:
+        yield tmp_file
+        assert claim is None or claim.still_held(), f'(!) Lost claim on {claim.task_name}, not writing {target}'
+        if tmp_file.is_dir() and target.is_dir():
+            shutil.rmtree(target)
+        os.replace(tmp_file, target)
+    finally:
+        if tmp_file.is_dir():
+            shutil.rmtree(tmp_file)
+        elif tmp_file.exists():
+            tmp_file.unlink()